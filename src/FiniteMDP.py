@@ -25,16 +25,33 @@ compute_optimal_action_values and others need to pass as parameters.
 '''
 from __future__ import print_function
 import numpy as np
+import heapq
+import warnings
 from builtins import print
 # from scipy.stats import rv_discrete
-from random import choices
+import scipy.sparse
+import scipy.sparse.linalg
 #from akpy.NextStateProbabilitiesEnv import NextStateProbabilitiesEnv
 from NextStateProbabilitiesEnv import NextStateProbabilitiesEnv
 import gym
 from gym import spaces
 
+# maximum fraction of nonzero entries for storing the transition probabilities as a sparse matrix
+SPARSE_MAX_DENSITY = 0.1
+# number of steps for which q_learning_batch() draws the random numbers at once
+QLEARNING_DRAWS_CHUNK_SIZE = 4096
+
 class FiniteMDP:
-    def __init__(self, environment: gym.Env):
+    def __init__(self, environment: gym.Env, dtype=np.float64, block_size=None):
+        '''dtype is used by the dynamic programming methods for the model and the
+        values. np.float32 halves the memory traffic of the backups, which is the
+        main cost for large S, at the expense of precision.
+        If block_size is provided, the backups of compute_optimal_state_values() and
+        compute_optimal_action_values(), and the improvement step of
+        compute_optimal_state_values_policy_iteration(), process that number of
+        states at a time, which keeps the intermediate action values in cache when
+        S is large (e.g. S*A*8 bytes much larger than the L2 cache).
+        compute_state_values() sweeps with the S x S matrix P_pi and is not blocked'''
         self.__version__ = "0.1.1"
         # print("AK Finite MDP - Version {}".format(self.__version__))
 
@@ -45,11 +62,71 @@ class FiniteMDP:
         self.environment = environment
         self.S = environment.observation_space.n
         self.A = environment.action_space.n
+        self.dtype = dtype
+        if block_size is not None and (isinstance(block_size, bool) or
+                                       not isinstance(block_size, (int, np.integer)) or block_size < 1):
+            raise ValueError('block_size must be None or a positive integer, got {!r}'.format(block_size))
+        self.block_size = block_size
+        # last converged values, used to warm-start the dynamic programming methods
+        self._values_cache = dict()
+        if isinstance(environment, NextStateProbabilitiesEnv):
+            self.update_model()
+
+        self._rng = np.random.default_rng()
 
         self.currentObservation = 0
         self.currentIteration = 0
         self.environment.reset()
 
+    def update_model(self):
+        '''Caches the model of the environment for the dynamic programming methods.
+        It is called by the constructor and must be called again if the
+        nextStateProbability or rewardsTable of the environment are modified'''
+        # p(s'|s,a), dimension S x A x S
+        self.P = np.ascontiguousarray(self.environment.nextStateProbability, dtype=self.dtype)
+        # same values seen as a (S*A) x S matrix, where row s*A+a is p(.|s,a).
+        # Most MDPs have only a few possible next states per (s,a), and a
+        # sparse matrix makes the backups proportional to the nonzero entries
+        self.P_mat = self.P.reshape(self.S * self.A, self.S)
+        if np.count_nonzero(self.P_mat) <= SPARSE_MAX_DENSITY * self.P_mat.size:
+            self.P_mat = scipy.sparse.csr_matrix(self.P_mat)
+        # list of (first state, last state + 1, rows of P_mat) used by _bellman_backup() and _bellman_sweep()
+        if self.block_size is None or self.block_size >= self.S:
+            self._state_blocks = [(0, self.S, self.P_mat)]
+        else:
+            self._state_blocks = [(s0, min(s0 + self.block_size, self.S),
+                                   self._rows_view(s0 * self.A, min(s0 + self.block_size, self.S) * self.A))
+                                  for s0 in range(0, self.S, self.block_size)]
+        # expected immediate reward r(s,a) = sum_s' p(s'|s,a) r(s,a,s'), dimension S x A.
+        # It is computed once here such that the (S, A, S) rewards are not read again
+        rewardsTable = self.environment.rewardsTable
+        if rewardsTable.ndim == 2:
+            # the reward does not depend on s', so it is already r(s,a)
+            self.ER = np.ascontiguousarray(rewardsTable, dtype=self.dtype)
+        else:
+            self.ER = np.ascontiguousarray(np.einsum('san,san->sa', self.P, rewardsTable),
+                                           dtype=self.dtype)
+        # the values computed for the previous model are not valid anymore, and
+        # step_batch() must sample the next states from the new model as step() does
+        self._values_cache.clear()
+        self.environment.invalidate_next_state_cdf()
+
+    def _rows_view(self, first_row, last_row):
+        '''Rows first_row to last_row - 1 of P_mat without copying the transition
+        probabilities. Slicing a sparse matrix copies its nonzero entries, so the
+        block is built on top of the data and indices arrays of P_mat instead'''
+        if not scipy.sparse.issparse(self.P_mat):
+            return self.P_mat[first_row:last_row]  # numpy slices are views
+        indptr = self.P_mat.indptr
+        start, end = indptr[first_row], indptr[last_row]
+        # the csr_matrix constructor copies views of larger arrays (see prune()), so
+        # the arrays are assigned after creating an empty matrix with the block shape
+        block = scipy.sparse.csr_matrix((last_row - first_row, self.S), dtype=self.P_mat.dtype)
+        block.data = self.P_mat.data[start:end]
+        block.indices = self.P_mat.indices[start:end]
+        block.indptr = indptr[first_row:last_row + 1] - start
+        return block
+
     def prettyPrintValues(self, action_values, stateListGivenIndex, actionListGivenIndex):
         '''
         Note that a policy is represented here as a distribution over the
@@ -68,52 +145,124 @@ class FiniteMDP:
                 print(' | a=', a, '=', currentAction, end='')
 
     def getEquiprobableRandomPolicy(self):
-        policy = np.zeros((self.S, self.A))
         uniformProbability = 1.0 / self.A
-        for s in range(self.S):
-            for a in range(self.A):
-                policy[s, a] = uniformProbability
-        return policy
+        return np.full((self.S, self.A), uniformProbability)
+
+    def _bellman_backup(self, state_values, discountGamma, out=None):
+        '''Returns the S x A action values r(s,a) + gamma sum_s' p(s'|s,a) v(s'),
+        which is the inner update shared by the dynamic programming methods.
+        If out is provided, the result is written to it. The states are processed
+        in the blocks of _state_blocks'''
+        if out is None:
+            out = np.empty((self.S, self.A), dtype=np.result_type(self.ER, state_values))
+        for s0, s1, P_block in self._state_blocks:
+            np.multiply((P_block @ state_values).reshape(s1 - s0, self.A), discountGamma, out=out[s0:s1])
+            out[s0:s1] += self.ER[s0:s1]
+        return out
+
+    def _bellman_sweep(self, state_values, discountGamma, out):
+        '''Writes to out the new state values max_a q(s,a), where q(s,a) is computed
+        as in _bellman_backup(). Only the action values of a block of states are
+        stored at a time'''
+        for s0, s1, P_block in self._state_blocks:
+            action_values = (P_block @ state_values).reshape(s1 - s0, self.A)
+            action_values *= discountGamma
+            action_values += self.ER[s0:s1]
+            action_values.max(axis=1, out=out[s0:s1])
+        return out
+
+    def _policy_model(self, policy):
+        '''Returns the S x S matrix P_pi(s'|s) = sum_a pi(a|s) p(s'|s,a) and the
+        expected rewards r_pi(s) = sum_a pi(a|s) r(s,a) for the given policy.
+        The policy is converted to a sparse matrix, such that actions with zero
+        probability in deterministic or epsilon-greedy policies are skipped'''
+        S = self.S
+        A = self.A
+        policy = np.asarray(policy).reshape(S * A)
+        rows = np.flatnonzero(policy)  # indices s*A+a of the rows of P_mat
+        # W[s, s*A+a] = pi(a|s), such that P_pi = W @ P_mat
+        W = scipy.sparse.csr_matrix((policy[rows], (rows // A, rows)), shape=(S, S * A))
+        P_pi = W @ self.P_mat
+        P_pi = P_pi.astype(self.dtype)
+        r_pi = (W @ self.ER.reshape(S * A)).astype(self.dtype)
+        return P_pi, r_pi
+
+    def _warm_start(self, key, shape):
+        '''Returns a copy of the last values stored in the cache for key, or zeros'''
+        cached_values = self._values_cache.get(key)
+        if cached_values is None:
+            return np.zeros(shape, dtype=self.dtype)
+        return cached_values.copy()
+
+    def _stopping_threshold(self, tolerance, discountGamma):
+        '''Threshold for the max-norm of the update between two sweeps. Because the
+        Bellman operator is a gamma-contraction, stopping when the update is below
+        tolerance*(1-gamma)/gamma guarantees an error of at most tolerance, as long
+        as this is above the rounding error of self.dtype. Otherwise the threshold
+        is limited by the dtype precision, the error bound is larger than tolerance
+        and a warning is issued'''
+        if discountGamma == 0:
+            return np.inf  # a single sweep gives the exact values
+        if discountGamma >= 1:
+            return tolerance  # there is no contraction to rely on
+        threshold = tolerance * (1 - discountGamma) / discountGamma
+        # the update cannot be smaller than the rounding error of the values, which
+        # are bounded by max|r(s,a)| / (1-gamma), otherwise the loop never stops
+        max_value = np.max(np.abs(self.ER)) / (1 - discountGamma)
+        precision_threshold = 4 * np.finfo(self.dtype).eps * max_value
+        if precision_threshold > threshold:
+            error_bound = precision_threshold * discountGamma / (1 - discountGamma)
+            warnings.warn('tolerance {} is below the precision of {}, the error is only guaranteed '
+                          'to be at most {:.3g}'.format(tolerance, np.dtype(self.dtype).name, error_bound),
+                          stacklevel=3)
+            return precision_threshold
+        return threshold
 
     '''
     Iterative policy evaluation. Page 75 of [Sutton, 2018].
     Here a policy (not necessarily optimum) is provided.
     It can generate, for instance, Fig. 3.2 in [Sutton, 2018]
     '''
-    def compute_state_values(self, policy, in_place=False, discountGamma = 0.9):
+    def compute_state_values(self, policy, in_place=False, discountGamma = 0.9, tolerance = 1e-4):
         S = self.S
-        A = self.A
-        #(S, A, nS) = self.environment.nextStateProbability.shape
-        # A = len(actionListGivenIndex)
-        new_state_values = np.zeros((S,))
-        state_values = new_state_values.copy()
+        # the policy does not change, so all sweeps use v = r_pi + gamma P_pi v
+        P_pi, r_pi = self._policy_model(policy)
+        # iterative evaluation converges from any start, so the values of the last
+        # evaluated policy are a good start for a similar one, as in policy iteration
+        key = ('state_values', id(self.environment), discountGamma)
+        # two buffers that alternate as old and new values, to avoid copies
+        state_values = self._warm_start(key, (S,))
+        new_state_values = np.zeros((S,), dtype=self.dtype)
+        threshold = self._stopping_threshold(tolerance, discountGamma)
         iteration = 1
         while True:
-            src = new_state_values if in_place else state_values
-            for s in range(S):
-                value = 0
-                for a in range(A):
-                    if policy[s, a] == 0:
-                        continue  # save computation
-                    for nexts in range(S):
-                        p = self.environment.nextStateProbability[s, a, nexts]
-                        r = self.environment.rewardsTable[s, a, nexts]
-                        value += policy[s, a] * p * (r + discountGamma * src[nexts])
-                        # value += p*(r+discount*src[nexts])
-                new_state_values[s] = value
-            # AK-TODO, Sutton, end of pag. 75 uses the max of individual entries, while
-            # here we are using the summation:
-            improvement = np.sum(np.abs(new_state_values - state_values))
+            if in_place:
+                # states updated earlier in the sweep are used by the next ones
+                np.copyto(new_state_values, state_values)
+                if scipy.sparse.issparse(P_pi):
+                    # read each row from the CSR arrays, such that a step costs O(nonzeros)
+                    for s in range(S):
+                        lo, hi = P_pi.indptr[s], P_pi.indptr[s + 1]
+                        new_state_values[s] = r_pi[s] + discountGamma * (
+                                P_pi.data[lo:hi] @ new_state_values[P_pi.indices[lo:hi]])
+                else:
+                    for s in range(S):
+                        new_state_values[s] = r_pi[s] + discountGamma * (P_pi[s] @ new_state_values)
+            else:
+                np.multiply(P_pi @ state_values, discountGamma, out=new_state_values)
+                new_state_values += r_pi
+            # use the max of individual entries, as in Sutton, end of pag. 75
+            improvement = np.max(np.abs(new_state_values - state_values))
             # print('improvement =', improvement)
             if False:  # debug
                 print('state values=', state_values)
                 print('new state values=', new_state_values)
                 print('it=', iteration, 'improvement = ', improvement)
-            if improvement < 1e-4:
-                state_values = new_state_values.copy()
+            state_values, new_state_values = new_state_values, state_values
+            if improvement < threshold:
+                self._values_cache[key] = state_values.copy()
                 break
 
-            state_values = new_state_values.copy()
             iteration += 1
 
         return state_values, iteration
@@ -124,120 +273,223 @@ class FiniteMDP:
     this method in called "the optimal state-value function" and defined in
     Eq. (3.15) in page 62.
     '''
-    def compute_optimal_state_values(self, discountGamma = 0.9):
+    def compute_optimal_state_values(self, discountGamma = 0.9, tolerance = 1e-4):
         '''Page 63 of [Sutton, 2018], Eq. (3.19)'''
         S = self.S
-        A = self.A
-        #(S, A, nS) = self.environment.nextStateProbability.shape
-        # A = len(actionListGivenIndex)
-        new_state_values = np.zeros((S,))
-        state_values = new_state_values.copy()
+        key = ('optimal_state_values', id(self.environment), discountGamma)
+        # two buffers that alternate as old and new values, to avoid copies
+        state_values = self._warm_start(key, (S,))
+        new_state_values = np.zeros((S,), dtype=self.dtype)
+        threshold = self._stopping_threshold(tolerance, discountGamma)
         iteration = 1
         while True:
-            for s in range(S):
-                a_candidates = list()
-                for a in range(A):
-                    value = 0
-                    for nexts in range(S):
-                        p = self.environment.nextStateProbability[s, a, nexts]
-                        r = self.environment.rewardsTable[s, a, nexts]
-                        value += p * (r + discountGamma * state_values[nexts])
-                    a_candidates.append(value)
-                new_state_values[s] = np.max(a_candidates)
-            improvement = np.sum(np.abs(new_state_values - state_values))
+            self._bellman_sweep(state_values, discountGamma, new_state_values)
+            improvement = np.max(np.abs(new_state_values - state_values))
             # print('improvement =', improvement)
             if False:  # debug
                 print('state values=', state_values)
                 print('new state values=', new_state_values)
                 print('it=', iteration, 'improvement = ', improvement)
 
-            state_values = new_state_values.copy()
-            if improvement < 1e-4:
+            state_values, new_state_values = new_state_values, state_values
+            if improvement < threshold:
+                self._values_cache[key] = state_values.copy()
                 break
 
             iteration += 1
 
         return state_values, iteration
 
+    '''
+    Alternative to compute_optimal_state_values() based on policy iteration,
+    page 80 of [Sutton, 2018]. The policy evaluation step is solved exactly
+    as a linear system instead of iteratively, and the greedy policy often
+    becomes stable after a few iterations, long before value iteration converges.
+    '''
+    def compute_optimal_state_values_policy_iteration(self, discountGamma = 0.9):
+        '''Returns the optimal state values, the deterministic optimal policy (one
+        action index per state) and the number of policy iterations'''
+        S = self.S
+        A = self.A
+        all_states = np.arange(S)
+        policy = np.zeros((S,), dtype=int)
+        iteration = 1
+        while True:
+            # policy evaluation: v = r_pi + gamma P_pi v, solved in float64 for any self.dtype
+            P_pi = self.P_mat[all_states * A + policy]
+            r_pi = self.ER[all_states, policy]
+            if scipy.sparse.issparse(P_pi):
+                state_values = scipy.sparse.linalg.spsolve(
+                    (scipy.sparse.identity(S) - discountGamma * P_pi).tocsc(), r_pi)
+            else:
+                state_values = np.linalg.solve(np.eye(S) - discountGamma * P_pi, r_pi)
+            # policy improvement
+            action_values = self._bellman_backup(state_values, discountGamma)
+            new_policy = action_values.argmax(axis=1)
+            # keep current action in case of ties, otherwise it may alternate among equivalent policies
+            is_tie = action_values[all_states, policy] >= action_values[all_states, new_policy] - 1e-12
+            new_policy[is_tie] = policy[is_tie]
+            if np.array_equal(new_policy, policy):
+                break
+            policy = new_policy
+            iteration += 1
+
+        return state_values, policy, iteration
+
+    '''
+    Specialization of compute_optimal_state_values() for MDPs without cycles, such as
+    episodic MDPs with the time step as part of the state. If the states are visited
+    in reverse topological order, the values of all next states are already final, and
+    a single backward sweep gives the exact solution of the Bellman optimality equation.
+    A state may lead to itself, such as an absorbing terminal state, because its own
+    fixed point v(s) = r(s,a) + gamma [p(s|s,a) v(s) + sum_{s'!=s} p(s'|s,a) v(s')]
+    can be solved for v(s).
+    '''
+    def compute_optimal_state_values_dag(self, topo_order=None, discountGamma = 0.9):
+        '''topo_order is a topological order of the states, as returned by
+        topological_sort_from_P(), which is called if it is not provided'''
+        S = self.S
+        A = self.A
+        if topo_order is None:
+            topo_order = topological_sort_from_P(self.P)
+            if topo_order is None:
+                raise ValueError('The MDP has cycles, use compute_optimal_state_values() instead')
+        state_values = np.zeros((S,), dtype=self.dtype)
+        for s in reversed(topo_order):
+            # state_values[s] is still zero, so the product only sums over s' != s
+            action_values_s = self.ER[s] + discountGamma * (self.P_mat[s * A:(s + 1) * A] @ state_values)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                action_values_s = action_values_s / (1 - discountGamma * self.P[s, :, s])
+            # with gamma = 1, staying forever in s with zero reward has value 0
+            action_values_s[np.isnan(action_values_s)] = 0
+            state_values[s] = np.max(action_values_s)
+        iteration = 1
+        return state_values, iteration
+
+    '''
+    Alternative to compute_optimal_state_values() based on prioritized sweeping,
+    page 170 of [Sutton, 2018]. Instead of full sweeps, it updates one state at a time,
+    always the one with the largest Bellman residual, and only its predecessors need
+    to be checked again. States whose values are already accurate are not updated.
+    '''
+    def compute_optimal_state_values_prioritized(self, discountGamma = 0.9, tolerance = 1e-4):
+        '''Returns the optimal state values and the number of state updates. It stops
+        when all residuals are below tolerance*(1-gamma), which guarantees an error of
+        at most tolerance, unless it is limited by the precision of self.dtype'''
+        S = self.S
+        P = self.P
+        ER = self.ER
+        if 0 < discountGamma < 1:
+            # a residual is gamma times the update bounded by _stopping_threshold()
+            threshold = discountGamma * self._stopping_threshold(tolerance, discountGamma)
+        else:
+            threshold = tolerance
+        # for each state, the possible next states and their probabilities for each action
+        successors = list()
+        predecessors = [list() for s in range(S)]
+        for s in range(S):
+            nextStates = np.flatnonzero(np.any(P[s] > 0, axis=0))
+            successors.append((nextStates, P[s][:, nextStates]))
+            for nexts in nextStates:
+                predecessors[nexts].append(s)
+
+        key = ('optimal_state_values', id(self.environment), discountGamma)
+        state_values = self._warm_start(key, (S,))
+
+        def bellman_update(s):
+            (nextStates, P_s) = successors[s]
+            return np.max(ER[s] + discountGamma * (P_s @ state_values[nextStates]))
+
+        # max-heap of residuals, implemented with negative values in a min-heap
+        priority_queue = list()
+        for s in range(S):
+            residual = abs(bellman_update(s) - state_values[s])
+            if residual > threshold:
+                heapq.heappush(priority_queue, (-residual, s))
+        num_updates = 0
+        while priority_queue:
+            _, s = heapq.heappop(priority_queue)
+            new_value = bellman_update(s)
+            if abs(new_value - state_values[s]) <= threshold:
+                continue  # s was updated after this entry was pushed
+            state_values[s] = new_value
+            num_updates += 1
+            for previous_s in predecessors[s]:
+                residual = abs(bellman_update(previous_s) - state_values[previous_s])
+                if residual > threshold:
+                    heapq.heappush(priority_queue, (-residual, previous_s))
+
+        self._values_cache[key] = state_values.copy()
+        return state_values, num_updates
+
     '''
     In [Sutton, 2018] the main result of this method in called "the optimal
     action-value function" and defined in Eq. (3.16) in page 63.
     '''
-    def compute_optimal_action_values(self, discountGamma = 0.9):
+    def compute_optimal_action_values(self, discountGamma = 0.9, tolerance = 1e-4):
         '''Page 64 of [Sutton, 2018], Eq. (3.20)'''
         S = self.S
         A = self.A
-        #(S, A, nS) = self.environment.nextStateProbability.shape
-        # A = len(actionListGivenIndex)
-        new_action_values = np.zeros((S, A))
-        action_values = new_action_values.copy()
+        key = ('optimal_action_values', id(self.environment), discountGamma)
+        # two buffers that alternate as old and new values, to avoid copies
+        action_values = self._warm_start(key, (S, A))
+        new_action_values = np.zeros((S, A), dtype=self.dtype)
+        state_values = np.zeros((S,), dtype=self.dtype)
+        threshold = self._stopping_threshold(tolerance, discountGamma)
         iteration = 1
         while True:
-            # src = new_action_values if in_place else action_values
-            for s in range(S):
-                for a in range(A):
-                    value = 0
-                    for nexts in range(S):
-                        p = self.environment.nextStateProbability[s, a, nexts] #p(s'|s,a) = p(nexts|s,a)
-                        r = self.environment.rewardsTable[s, a, nexts] #r(s,a,s') = r(s,a,nexts)
-                        best_a = -np.Infinity
-                        for nexta in range(A):
-                            temp = action_values[nexts, nexta]
-                            if temp > best_a:
-                                best_a = temp
-                        value += p * (r + discountGamma * best_a)
-                        # value += p*(r+discount*src[nexts])
-                        # print('aa', value)
-                    new_action_values[s, a] = value
-            improvement = np.sum(np.abs(new_action_values - action_values))
+            # the best next action does not depend on (s,a), so compute it once per sweep
+            np.max(action_values, axis=1, out=state_values)
+            self._bellman_backup(state_values, discountGamma, out=new_action_values)
+            improvement = np.max(np.abs(new_action_values - action_values))
             # print('improvement =', improvement)
             if False:  # debug
                 print('state values=', action_values)
                 print('new state values=', new_action_values)
                 print('it=', iteration, 'improvement = ', improvement)
-            if improvement < 1e-4:
-                action_values = new_action_values.copy()
+            action_values, new_action_values = new_action_values, action_values
+            if improvement < threshold:
+                self._values_cache[key] = action_values.copy()
                 break
 
-            action_values = new_action_values.copy()
             iteration += 1
 
         return action_values, iteration
 
     def convert_action_values_into_policy(self, action_values):
-        (S, A) = action_values.shape
-        policy = np.zeros((S, A))
-        for s in range(S):
-            maxPerState = max(action_values[s])
-            maxIndices = np.where(action_values[s] == maxPerState)
-            # maxIndices is a tuple and we want to get first element maxIndices[0]
-            policy[s, maxIndices] = 1.0 / len(maxIndices[0])  # impose uniform distribution
+        maxPerState = np.max(action_values, axis=1, keepdims=True)
+        isMax = action_values == maxPerState
+        # impose uniform distribution over the actions with maximum value
+        policy = isMax / np.sum(isMax, axis=1, keepdims=True)
         return policy
 
     def postprocessing_MDP_step(self, history, printPostProcessingInfo):
         '''This method can be overriden by subclass and process history'''
         pass  # no need to do anything here
 
+    def _policy_cdf(self, policy):
+        '''Cumulative distribution of the actions for each state, such that
+        an action can be drawn with a single searchsorted'''
+        myweights = np.array(policy, dtype=np.float64).reshape(self.S, self.A)
+        sumWeights = np.sum(myweights, axis=1) #AK-TODO: what if there are positive and negative numbers canceling out?
+        myweights[sumWeights == 0] = 1
+        #AK-TODO sampling is giving troubles with negative weights. Make them all positive
+        #AK-TODO this changes the relative importances / weights, right?
+        minWeights = np.min(myweights, axis=1, keepdims=True)
+        myweights -= np.where(minWeights < 0, minWeights - 1e-30, 0)
+        cdf = np.cumsum(myweights, axis=1)
+        cdf /= cdf[:, -1:]
+        return cdf
+
     def run_MDP_for_given_policy(self, policy, maxNumIterations=100, printInfo=False, printPostProcessingInfo=False):
         self.environment.reset()
         s = self.environment.get_state()
         totalReward = 0
         #if printInfo:
             #print('Initial state = ', self.stateListGivenIndex[s])
+        policy_cdf = self._policy_cdf(policy)
         for it in range(maxNumIterations):
-            myweights = np.squeeze(policy[s])
-            sumWeights = np.sum(myweights) #AK-TODO: what if there are positive and negative numbers canceling out?
-            if sumWeights == 0:
-                myweights = np.ones(myweights.shape)
-            if True:
-                #AK-TODO the choices is giving troubles with negative weights. Make them all positive
-                #AK-TODO this changes the relative importances / weights, right?
-                minWeight = np.min(myweights)
-                if minWeight < 0:
-                    myweights += (-minWeight)+1e-30
-                sumWeights = np.sum(myweights)
-                myweights /= sumWeights
-            action = choices(np.arange(self.A), weights=myweights, k=1)[0]
+            action = int(np.searchsorted(policy_cdf[s], self._rng.random(), side='right'))
             ob, reward, gameOver, history = self.environment.step(action)
 
             #AK
@@ -269,7 +521,6 @@ class FiniteMDP:
 
             ob, reward, gameOver, history = self.environment.step(currentAction)
             newState = self.environment.get_state()
-            reward = self.environment.rewardsTable[currentState, currentAction, newState]
             #reward = self.environment.get_current_reward()
             rewards += reward
             # Q-Learning update
@@ -283,29 +534,70 @@ class FiniteMDP:
     # choose an action based on epsilon greedy algorithm
     def chooseAction(self, state, stateActionValues, explorationProbEpsilon=0.01):
         #print(state)
-        if np.random.binomial(1, explorationProbEpsilon) == 1:
-            return np.random.choice(np.arange(self.A))
+        if self._rng.random() < explorationProbEpsilon:
+            return self._rng.integers(self.A)
         else:
             values_ = stateActionValues[state, :]
-            return np.random.choice([action_ for action_, value_ in enumerate(values_) if value_ == np.max(values_)])
+            return self._rng.choice(np.flatnonzero(values_ == values_.max()))
+
+    # episodes with Q-Learning for a batch of independent runs, which share
+    # the environment model but have their own states and action values
+    # @stateActionValues: values for state action pairs with dimension num_runs x S x A, will be updated
+    # @currentStates: current state of each run, will be updated
+    # @return: total rewards within this episode for each run
+    def q_learning_batch(self, stateActionValues, currentStates, maxNumIterationsQLearning=100, stepSizeAlpha=0.1,
+                         explorationProbEpsilon=0.01, discountGamma = 0.9):
+        num_runs = len(currentStates)
+        runs = np.arange(num_runs)
+        rewards = np.zeros((num_runs,))
+        for numIterations in range(maxNumIterationsQLearning):
+            # draw the exploration decisions for a chunk of steps at once, which
+            # limits the memory to QLEARNING_DRAWS_CHUNK_SIZE x num_runs values
+            chunkIndex = numIterations % QLEARNING_DRAWS_CHUNK_SIZE
+            if chunkIndex == 0:
+                chunkSize = min(QLEARNING_DRAWS_CHUNK_SIZE, maxNumIterationsQLearning - numIterations)
+                explore = self._rng.random((chunkSize, num_runs)) < explorationProbEpsilon
+                randomActions = self._rng.integers(self.A, size=(chunkSize, num_runs))
+            currentActions = self.chooseActionBatch(currentStates, stateActionValues,
+                                                    explore[chunkIndex], randomActions[chunkIndex])
+
+            newStates, reward = self.environment.step_batch(currentStates, currentActions, self._rng)
+            rewards += reward
+            # Q-Learning update
+            stateActionValues[runs, currentStates, currentActions] += stepSizeAlpha * (
+                    reward + discountGamma * stateActionValues[runs, newStates, :].max(axis=1) -
+                    stateActionValues[runs, currentStates, currentActions])
+            currentStates[:] = newStates
+        # normalize rewards to facilitate comparison
+        return rewards / maxNumIterationsQLearning
+
+    # choose an action for each run based on epsilon greedy algorithm, breaking ties at random
+    # @explore: boolean array indicating the runs that take randomActions instead of the greedy one
+    def chooseActionBatch(self, states, stateActionValues, explore, randomActions):
+        values_ = stateActionValues[np.arange(len(states)), states, :]
+        isBest = values_ == values_.max(axis=1, keepdims=True)
+        greedyActions = np.where(isBest, self._rng.random(values_.shape), -1).argmax(axis=1)
+        return np.where(explore, randomActions, greedyActions)
 
     def execute_q_learning(self, maxNumIterations=100, maxNumIterationsQLearning=10, num_runs=1,
                            stepSizeAlpha=0.1, explorationProbEpsilon=0.01):
-        '''Use independent runs instead of a single run.
+        '''Use independent runs instead of a single run. The runs are
+        executed simultaneously, with vectorized updates over the runs.
         maxNumIterationsQLearning is used to smooth numbers'''
 
         rewardsQLearning = np.zeros(maxNumIterations)
-        for run in range(num_runs):
-            stateActionValues = np.zeros((self.S, self.A))
-            for i in range(maxNumIterations):
-                # update stateActionValues in-place
-                reward = self.q_learning(stateActionValues,
-                                         maxNumIterationsQLearning=maxNumIterationsQLearning,
-                                         stepSizeAlpha=stepSizeAlpha,
-                                         explorationProbEpsilon=explorationProbEpsilon)
-                rewardsQLearning[i] += reward
-            #print('rewardsQLearning[i]', rewardsQLearning[i]) #AK
+        allStateActionValues = np.zeros((num_runs, self.S, self.A))
+        currentStates = np.array([self.environment.reset() for run in range(num_runs)])
+        for i in range(maxNumIterations):
+            # update allStateActionValues and currentStates in-place
+            rewards = self.q_learning_batch(allStateActionValues, currentStates,
+                                            maxNumIterationsQLearning=maxNumIterationsQLearning,
+                                            stepSizeAlpha=stepSizeAlpha,
+                                            explorationProbEpsilon=explorationProbEpsilon)
+            rewardsQLearning[i] = np.sum(rewards)
         rewardsQLearning /= num_runs
+        # as when running one at a time, return the values of the last run
+        stateActionValues = allStateActionValues[-1]
         if False:
             print('rewardsQLearning = ', rewardsQLearning)
             print('newStateActionValues = ', stateActionValues)
@@ -313,6 +605,26 @@ class FiniteMDP:
             print('qlearning_policy = ', self.prettyPrintPolicy(stateActionValues))
         return stateActionValues, rewardsQLearning
 
+def topological_sort_from_P(nextStateProbability):
+    '''Returns the states sorted such that s comes before s' != s whenever
+    p(s'|s,a) > 0 for some action a, or None if there is no such order because the
+    MDP has cycles. Self-loops, as in absorbing terminal states, are not cycles here'''
+    S = nextStateProbability.shape[0]
+    # isSuccessor[s, nexts] indicates that nexts != s can be reached from s in one step
+    isSuccessor = np.any(nextStateProbability > 0, axis=1)
+    np.fill_diagonal(isSuccessor, False)
+    numPredecessors = np.sum(isSuccessor, axis=0)
+    # Kahn's algorithm: repeatedly take states whose predecessors were already taken
+    order = list(np.flatnonzero(numPredecessors == 0))
+    for s in order:  # the list grows while it is traversed
+        for nexts in np.flatnonzero(isSuccessor[s]):
+            numPredecessors[nexts] -= 1
+            if numPredecessors[nexts] == 0:
+                order.append(nexts)
+    if len(order) < S:
+        return None
+    return np.array(order)
+
 def test_with_NextStateProbabilitiesEnv():
     S = 3
     A = 2
@@ -16,6 +16,8 @@ class NextStateProbabilitiesEnv(gym.Env):
         self.__version__ = "0.1.0"
         # print("AK Finite MDP - Version {}".format(self.__version__))
         self.nextStateProbability = nextStateProbability
+        # r(s,a,s') with dimension S x A x S. When the reward does not depend on the
+        # next state, it can be S x A instead, which uses S times less memory
         self.rewardsTable = rewardsTable #expected rewards
 
         self.currentObservation = 0
@@ -24,6 +26,13 @@ class NextStateProbabilitiesEnv(gym.Env):
         self.S = nextStateProbability.shape[0]  # number of states
         self.A = nextStateProbability.shape[1]  # number of actions
 
+        # random generator used by step_batch() when none is provided
+        self._rng = np.random.default_rng()
+        # cumulative distribution of the next states, created by step_batch() when first needed
+        # and rebuilt when it does not correspond to the current nextStateProbability
+        self.nextStateCDF = None
+        self._nextStateCDFSource = None
+
         self.action_space = spaces.Discrete(self.A)
         self.observation_space = spaces.Discrete(self.S) #states are called observations in gym
 
@@ -53,13 +62,13 @@ class NextStateProbabilitiesEnv(gym.Env):
 
         # p = self.nextStateProbability[s,action]
         # reward = self.rewardsTable[s,action, nexts][0]
-        reward = self.rewardsTable[s, action, nexts]
+        reward = self.get_reward(s, action, nexts)
 
         # fully observable MDP: observation is the actual state
         self.currentObservation = nexts
 
         gameOver = False
-        if self.currentIteration > np.Inf:
+        if self.currentIteration > np.inf:
             ob = self.reset()
             gameOver = True  # game ends
         else:
@@ -73,6 +82,56 @@ class NextStateProbabilitiesEnv(gym.Env):
         self.currentIteration += 1
         return ob, reward, gameOver, history
 
+    def step_batch(self, states, actions, rng=None):
+        """
+        Vectorized version of step() for a batch of independent copies of this
+        environment, such as the runs in FiniteMDP.execute_q_learning(). It does
+        not change the current state of the environment.
+        Parameters
+        ----------
+        states : array of integers with the current state of each copy
+        actions : array of integers with the action taken in each copy
+        rng : numpy.random.Generator used to sample the next states, such that
+            the caller can make the runs reproducible. Defaults to the env's own
+        Returns
+        -------
+        nexts, rewards : tuple
+            nexts (array of integers) : next state of each copy
+            rewards (array of floats) : reward of each copy
+        """
+        if self.nextStateCDF is None or self._nextStateCDFSource is not self.nextStateProbability:
+            self.nextStateCDF = self.compute_next_state_cdf()
+            self._nextStateCDFSource = self.nextStateProbability
+        cdf = self.nextStateCDF[states, actions]
+        if rng is None:
+            rng = self._rng
+        u = rng.random(len(states))
+        nexts = (cdf <= u[:, None]).sum(axis=1)
+        rewards = self.get_reward(states, actions, nexts)
+        return nexts, rewards
+
+    def compute_next_state_cdf(self):
+        """Cumulative distribution of the next states for each (s,a), such that
+        step_batch() samples them with a comparison. As in step(), the weights in
+        nextStateProbability are not required to be normalized."""
+        cdf = np.cumsum(self.nextStateProbability, axis=2)
+        totals = cdf[:, :, -1:]
+        return np.divide(cdf, totals, out=np.ones_like(cdf, dtype=np.float64), where=totals > 0)
+
+    def invalidate_next_state_cdf(self):
+        """Discards the cached nextStateCDF, such that step_batch() samples from the
+        current nextStateProbability. A new nextStateProbability array is detected
+        automatically, but this must be called if the array is modified in place."""
+        self.nextStateCDF = None
+        self._nextStateCDFSource = None
+
+    def get_reward(self, s, action, nexts):
+        """Get r(s,a,s') from rewardsTable, which may not depend on s'.
+        The arguments can also be arrays of indices."""
+        if self.rewardsTable.ndim == 2:
+            return self.rewardsTable[s, action]
+        return self.rewardsTable[s, action, nexts]
+
     def get_state(self):
         """Get the current observation."""
         return self.currentObservation